@@ -0,0 +1,161 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class CompletionCacheService:
+    """
+    Exact-match cache of completions in SQLite, shared by every worker on the host.
+
+    Keys cover the model, the prompt template, the question, the retrieved chunks and the session's
+    knowledge version, so remembering or forgetting anything invalidates the session's answers.
+    Entries expire after a TTL. When the database file exceeds its size cap, the least recently used
+    entries are evicted down to a low-water mark, freed pages are returned to the filesystem and the
+    WAL is truncated.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv('COMPLETION_CACHE_ENABLED', 'true').lower() == 'true'
+        self._path = os.getenv('COMPLETION_CACHE_PATH', '.cache/completions.sqlite')
+        self._ttl = float(os.getenv('COMPLETION_CACHE_TTL_SECONDS', '86400'))
+        self._max_bytes = int(os.getenv('COMPLETION_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+        # Eviction goes down to this fraction of the cap, so a full cache does not evict on every put.
+        self._low_water_bytes = int(self._max_bytes * float(os.getenv('COMPLETION_CACHE_LOW_WATER', '0.8')))
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+        logger.info(f"Initializing CompletionCacheService({self._path})")
+        Path(self._path).parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as connection:
+            if connection.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # Incremental auto-vacuum lets eviction shrink the file; existing files need one VACUUM to switch.
+                connection.execute("PRAGMA auto_vacuum=INCREMENTAL")
+                connection.execute("VACUUM")
+            connection.execute("PRAGMA journal_mode=WAL")
+        with closing(self._connect()) as connection, connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    answer TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS completions_accessed_at ON completions (accessed_at)")
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS knowledge_versions (
+                    session_id TEXT PRIMARY KEY,
+                    version INTEGER NOT NULL
+                )
+            """)
+
+    @property
+    def stats(self) -> dict[str, float]:
+        with closing(self._connect()) as connection:
+            entries, size = connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+            file_size = self._file_size(connection)
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": entries,
+                "bytes": size,
+                "file_bytes": file_size,
+                "max_bytes": self._max_bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_rate": self._hits / lookups if lookups else 0.0,
+            }
+
+    def version(self, session_id: str) -> int:
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                "SELECT version FROM knowledge_versions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, session_id: str):
+        with closing(self._connect()) as connection, connection:
+            connection.execute("""
+                INSERT INTO knowledge_versions (session_id, version) VALUES (?, 1)
+                ON CONFLICT (session_id) DO UPDATE SET version = version + 1
+            """, (session_id,))
+
+    def key(self, model: str, template_version: str, question: str, chunk_ids: list[str], session_id: str) -> str:
+        chunks = hashlib.sha256("\n".join(sorted(chunk_ids)).encode()).hexdigest()
+        parts = [model, template_version, question, chunks, session_id, self.version(session_id)]
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            row = connection.execute(
+                "SELECT answer FROM completions WHERE key = ? AND created_at > ?", (key, now - self._ttl)
+            ).fetchone()
+            if row:
+                connection.execute("UPDATE completions SET accessed_at = ? WHERE key = ?", (now, key))
+
+        with self._lock:
+            if row:
+                self._hits += 1
+            else:
+                self._misses += 1
+        return row[0] if row else None
+
+    def put(self, key: str, answer: str):
+        now = time.time()
+        with closing(self._connect()) as connection:
+            with connection:
+                connection.execute("""
+                    INSERT OR REPLACE INTO completions (key, answer, size, created_at, accessed_at)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (key, answer, len(key) + len(answer.encode()) + 32, now, now))
+                connection.execute("DELETE FROM completions WHERE created_at <= ?", (now - self._ttl,))
+
+            if self._file_size(connection) > self._max_bytes:
+                self._evict(connection)
+
+    def _evict(self, connection: sqlite3.Connection):
+        # Row sizes only approximate pages, so eviction repeats until the file itself is under the low-water mark.
+        evicted = 0
+        while (excess := self._file_size(connection) - self._low_water_bytes) > 0:
+            with connection:
+                keys = []
+                for key, entry_size in connection.execute("SELECT key, size FROM completions ORDER BY accessed_at"):
+                    keys.append((key,))
+                    excess -= entry_size
+                    if excess <= 0:
+                        break
+                if not keys:
+                    break
+                connection.executemany("DELETE FROM completions WHERE key = ?", keys)
+                evicted += len(keys)
+            # The driver steps a pragma only once, which frees a single page; a script runs it to completion.
+            connection.executescript("PRAGMA incremental_vacuum")
+
+        if evicted:
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            logger.info("Evicted %s completions", evicted)
+
+    @staticmethod
+    def _file_size(connection: sqlite3.Connection) -> int:
+        [page_count] = connection.execute("PRAGMA page_count").fetchone()
+        [page_size] = connection.execute("PRAGMA page_size").fetchone()
+        return page_count * page_size
+
+    def _connect(self) -> sqlite3.Connection:
+        # A connection per call keeps access safe across threads; WAL and the busy timeout across processes.
+        connection = sqlite3.connect(self._path, timeout=30)
+        # Per-connection setting: the WAL is truncated to this size whenever it is checkpointed.
+        connection.execute(f"PRAGMA journal_size_limit={self._max_bytes // 8}")
+        return connection
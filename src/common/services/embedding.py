@@ -1,27 +1,201 @@
+import hashlib
+import json
 import logging
 import os
+import threading
+from collections import OrderedDict
+from typing import Optional
 
 from langchain.embeddings import CacheBackedEmbeddings
 from langchain.storage import LocalFileStore
 from langchain_core.embeddings import Embeddings
+from langchain_core.stores import ByteStore
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_ollama import OllamaEmbeddings
 from langchain_openai import OpenAIEmbeddings
 
+from src.common.services.embedding_pool import PooledEmbeddings
+
 logger = logging.getLogger(__name__)
 
 
+class QueryCachedEmbeddings(Embeddings):
+    """
+    Caches embed_query results in a bounded in-process LRU, optionally backed by a byte store.
+    A LocalFileStore is capped at `max_store_size` files by a background thread that deletes the least
+    recently used ones by mtime; it should not be shared with document embeddings.
+    """
+
+    def __init__(self,
+                 embeddings: Embeddings,
+                 namespace: str,
+                 max_size: int = 1024,
+                 store: Optional[ByteStore] = None,
+                 max_store_size: int = 65536):
+        self._embeddings = embeddings
+        # Batched query misses bypass a document cache, which would otherwise keep a copy of every query.
+        self._uncached = embeddings.underlying_embeddings if isinstance(embeddings, CacheBackedEmbeddings) else embeddings
+        self._namespace = namespace
+        self._max_size = max_size
+        self._store = store
+        self._max_store_size = max_store_size
+        self._store_writes = 0
+        self._prune_requested = threading.Event()
+        self._lru: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._store_hits = 0
+        self._misses = 0
+
+        if isinstance(store, LocalFileStore):
+            threading.Thread(target=self._prune_forever, name="query-store-pruner", daemon=True).start()
+
+    @property
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            lookups = self._hits + self._store_hits + self._misses
+            return {
+                "size": len(self._lru),
+                "max_size": self._max_size,
+                "hits": self._hits,
+                "store_hits": self._store_hits,
+                "misses": self._misses,
+                "hit_rate": (self._hits + self._store_hits) / lookups if lookups else 0.0,
+            }
+
+    def key(self, text: str) -> str:
+        # Queries differing only in case or whitespace share one embedding.
+        normalized = " ".join(text.split()).lower()
+        return "query-" + hashlib.sha1(f"{self._namespace}\n{normalized}".encode()).hexdigest()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        return await self._embeddings.aembed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        key = self.key(text)
+        vector = self._lookup(key)
+        if vector is None:
+            vector = self._embeddings.embed_query(text)
+            self._save(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> list[float]:
+        key = self.key(text)
+        vector = self._lookup(key)
+        if vector is None:
+            vector = await self._embeddings.aembed_query(text)
+            self._save(key, vector)
+        return vector
+
+    def embed_queries(self, texts: list[str]) -> list[list[float]]:
+        """
+        Embeds many queries with a single batched call for the cache misses.
+        Assumes queries and documents share one embedding space, as with sentence-transformers.
+        """
+        keys = [self.key(x) for x in texts]
+        vectors = [self._lookup(x) for x in keys]
+
+        misses = {key: text for key, text, vector in zip(keys, texts, vectors) if vector is None}
+        if misses:
+            embedded = dict(zip(misses, self._uncached.embed_documents(list(misses.values()))))
+            for key, vector in embedded.items():
+                self._save(key, vector)
+            vectors = [vector if vector is not None else embedded[key] for key, vector in zip(keys, vectors)]
+
+        return vectors
+
+    def _lookup(self, key: str) -> Optional[list[float]]:
+        with self._lock:
+            if key in self._lru:
+                self._lru.move_to_end(key)
+                self._hits += 1
+                return self._lru[key]
+
+        if self._store:
+            [value] = self._store.mget([key])
+            if value is not None:
+                vector = json.loads(value.decode())
+                with self._lock:
+                    self._store_hits += 1
+                self._touch(key)
+                self._remember(key, vector)
+                return vector
+
+        with self._lock:
+            self._misses += 1
+        return None
+
+    def _save(self, key: str, vector: list[float]):
+        self._remember(key, vector)
+        if self._store:
+            self._store.mset([(key, json.dumps(vector).encode())])
+            with self._lock:
+                self._store_writes += 1
+                prune = self._store_writes % max(1, self._max_store_size // 10) == 0
+            if prune:
+                self._prune_requested.set()
+
+    def _touch(self, key: str):
+        # A file's mtime doubles as its last use, so store hits are kept by the pruner.
+        if isinstance(self._store, LocalFileStore):
+            try:
+                os.utime(self._store.root_path / key)
+            except FileNotFoundError:
+                pass
+
+    def _prune_forever(self):
+        # Scanning the store is a directory walk, so it runs off the request path
+        # and only after every tenth of the cap worth of writes.
+        while True:
+            self._prune_requested.wait()
+            self._prune_requested.clear()
+            try:
+                self._prune_store()
+            except Exception as e:
+                logger.error("Failed to prune persisted query embeddings! %s", e)
+
+    def _prune_store(self):
+        with os.scandir(self._store.root_path) as entries:
+            files = [(x.stat().st_mtime, x.path) for x in entries if x.name.startswith("query-") and x.is_file()]
+
+        excess = len(files) - self._max_store_size
+        if excess <= 0:
+            return
+
+        for _, path in sorted(files)[:excess]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        logger.info("Pruned %s persisted query embeddings", excess)
+
+    def _remember(self, key: str, vector: list[float]):
+        with self._lock:
+            self._lru[key] = vector
+            self._lru.move_to_end(key)
+            while len(self._lru) > self._max_size:
+                self._lru.popitem(last=False)
+
+
 class EmbeddingService:
     def __init__(self):
         providers = {
             "ollama": self.initialize_ollama,
             "openai": self.initialize_openai,
             "huggingface": self.initialize_huggingface,
+            "pool": self.initialize_pool,
         }
         model_name = os.getenv('EMBEDDING_MODEL', 'all-minilm:l6-v2')
         cache_location = os.getenv('EMBEDDINGS_CACHE_DIR', '.cache/embeddings')
-        self._embedding = self.cached(
-            providers[os.getenv('EMBEDDING_PROVIDER', 'ollama')](model_name),
+        self._embedding = self.query_cached(
+            self.cached(
+                providers[os.getenv('EMBEDDING_PROVIDER', 'ollama')](model_name),
+                cache_location
+            ),
+            model_name,
             cache_location
         )
 
@@ -39,6 +213,21 @@ class EmbeddingService:
             embeddings, LocalFileStore(location)
         )
 
+    @staticmethod
+    def query_cached(embeddings: Embeddings, model_name: str, location: str):
+        max_size = int(os.getenv('QUERY_EMBEDDINGS_CACHE_SIZE', '1024'))
+        max_store_size = int(os.getenv('QUERY_EMBEDDINGS_STORE_SIZE', '65536'))
+        persist = os.getenv('QUERY_EMBEDDINGS_CACHE_PERSIST', 'true').lower() == 'true'
+        logger.info(f"Initializing QueryCachedEmbeddings({model_name}, {max_size}, {persist})")
+        return QueryCachedEmbeddings(
+            embeddings,
+            namespace=model_name,
+            max_size=max_size,
+            # Queries live apart from document embeddings so they can be pruned or wiped on their own.
+            store=LocalFileStore(os.path.join(location, "queries")) if persist else None,
+            max_store_size=max_store_size
+        )
+
     @staticmethod
     def initialize_ollama(model_name: str):
         logger.info(f"Initializing OllamaEmbeddings({model_name})")
@@ -64,3 +253,9 @@ class EmbeddingService:
             model_kwargs={'device': 'cpu'},
             encode_kwargs={'normalize_embeddings': False}
         )
+
+    @staticmethod
+    def initialize_pool(model_name: str):
+        socket_path = os.getenv('EMBEDDING_POOL_SOCKET', '/tmp/embedding-pool.sock')
+        logger.info(f"Initializing PooledEmbeddings({model_name}, {socket_path})")
+        return PooledEmbeddings(socket_path, model_name)
@@ -0,0 +1,341 @@
+import json
+import logging
+import multiprocessing
+import os
+import socket
+import socketserver
+import struct
+import threading
+import time
+import uuid
+from collections import deque
+
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+
+def send_frame(connection: socket.socket, payload: dict):
+    data = json.dumps(payload).encode()
+    connection.sendall(struct.pack(">I", len(data)) + data)
+
+
+def receive_frame(connection: socket.socket) -> dict:
+    [length] = struct.unpack(">I", receive_exactly(connection, 4))
+    return json.loads(receive_exactly(connection, length))
+
+
+def receive_exactly(connection: socket.socket, length: int) -> bytes:
+    data = bytearray()
+    while len(data) < length:
+        chunk = connection.recv(length - len(data))
+        if not chunk:
+            raise ConnectionError("Embedding pool closed the connection")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def load_embeddings(model_name: str) -> Embeddings:
+    from langchain_huggingface import HuggingFaceEmbeddings
+
+    return HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={'device': 'cpu'},
+        encode_kwargs={'normalize_embeddings': False}
+    )
+
+
+def run_worker(slot: int, threads: int, model_name: str, tasks, results):
+    cores = sorted(os.sched_getaffinity(0))
+    os.sched_setaffinity(0, {cores[(slot * threads + x) % len(cores)] for x in range(threads)})
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+
+    embeddings = load_embeddings(model_name)
+    logger.info("Embedding worker %s is ready", slot)
+    results.put((slot, None, None, None, 0.0))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+
+        task_id, texts = task
+        started = time.monotonic()
+        try:
+            results.put((slot, task_id, embeddings.embed_documents(texts), None, time.monotonic() - started))
+        except Exception as e:
+            results.put((slot, task_id, None, str(e), time.monotonic() - started))
+
+
+class EmbeddingPoolService:
+    """
+    Runs one sentence-transformers copy per worker process, each pinned to its own cores, and serves
+    every API worker over a Unix socket. Large requests are split into sub-batches that run on several
+    workers at once. Scales between a minimum and maximum number of workers based on the backlog.
+    """
+
+    def __init__(self):
+        cores = len(os.sched_getaffinity(0))
+        self._model_name = os.getenv('EMBEDDING_MODEL', 'sentence-transformers/all-MiniLM-L6-v2')
+        self._socket_path = os.getenv('EMBEDDING_POOL_SOCKET', '/tmp/embedding-pool.sock')
+        # Half the cores per worker keeps a single short request close to in-process latency, which gains
+        # little from more intra-op threads, while large requests are spread over the workers.
+        self._threads = int(os.getenv('EMBEDDING_POOL_THREADS', str(max(1, cores // 2))))
+        self._max_workers = int(os.getenv('EMBEDDING_POOL_MAX_WORKERS', str(max(1, cores // self._threads))))
+        self._min_workers = int(os.getenv('EMBEDDING_POOL_MIN_WORKERS', '1'))
+        self._min_batch = int(os.getenv('EMBEDDING_POOL_MIN_BATCH', '16'))
+        self._timeout = float(os.getenv('EMBEDDING_POOL_TIMEOUT_SECONDS', '120'))
+        self._idle_seconds = float(os.getenv('EMBEDDING_POOL_IDLE_SECONDS', '60'))
+        self._max_attempts = 2
+
+        self._context = multiprocessing.get_context("spawn")
+        self._results = self._context.Queue()
+        self._workers: dict[int, tuple[multiprocessing.Process, multiprocessing.Queue]] = {}
+        self._idle: set[int] = set()
+        self._ready: set[int] = set()
+        self._ever_ready = False
+        # Workers that die before loading the model are respawned with exponential backoff.
+        self._startup_failures = 0
+        self._next_spawn = 0.0
+        self._assigned: dict[int, str] = {}
+        self._backlog: deque[str] = deque()
+        self._tasks: dict[str, tuple[list[str], threading.Event, list]] = {}
+        self._attempts: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._completed = 0
+        self._busy_seconds = 0.0
+        self._last_busy = time.monotonic()
+        # Per-tick (busy seconds, worker seconds) over the last minute, so utilization follows scaling.
+        self._window: deque[tuple[float, float]] = deque(maxlen=60)
+
+    @property
+    def stats(self) -> dict[str, float]:
+        with self._lock:
+            busy = sum(x for x, _ in self._window)
+            capacity = sum(x for _, x in self._window)
+            return {
+                "workers": len(self._workers),
+                "busy_workers": len(self._assigned),
+                "min_workers": self._min_workers,
+                "max_workers": self._max_workers,
+                "backlog": len(self._backlog),
+                "completed": self._completed,
+                "utilization": min(1.0, busy / capacity) if capacity else 0.0,
+            }
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        size = max(self._min_batch, -(-len(texts) // self._max_workers))
+        batches = [texts[x:x + size] for x in range(0, len(texts), size)]
+
+        task_ids = []
+        with self._lock:
+            if not self._ever_ready and self._startup_failures and not self._workers:
+                raise RuntimeError("No embedding worker could start")
+            for batch in batches:
+                task_id = uuid.uuid4().hex
+                self._tasks[task_id] = (batch, threading.Event(), [])
+                self._backlog.append(task_id)
+                task_ids.append(task_id)
+            self._dispatch()
+
+        deadline = time.monotonic() + self._timeout
+        try:
+            vectors = []
+            for task_id in task_ids:
+                _, done, outcome = self._tasks[task_id]
+                if not done.wait(max(0.0, deadline - time.monotonic())):
+                    raise TimeoutError(f"Embedding took longer than {self._timeout}s")
+                batch_vectors, error = outcome
+                if error:
+                    raise RuntimeError(error)
+                vectors.extend(batch_vectors)
+            return vectors
+        finally:
+            with self._lock:
+                for task_id in task_ids:
+                    self._tasks.pop(task_id, None)
+                    self._attempts.pop(task_id, None)
+                    if task_id in self._backlog:
+                        self._backlog.remove(task_id)
+
+    def serve_forever(self):
+        logger.info(f"Initializing EmbeddingPoolService({self._model_name}, {self._socket_path})")
+        with self._lock:
+            for _ in range(self._min_workers):
+                self._spawn()
+
+        threading.Thread(target=self._collect, daemon=True).start()
+        threading.Thread(target=self._autoscale, daemon=True).start()
+
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+
+        pool = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                request = receive_frame(self.request)
+                try:
+                    if request["op"] == "stats":
+                        send_frame(self.request, {"stats": pool.stats})
+                    else:
+                        send_frame(self.request, {"vectors": pool.embed(request["texts"])})
+                except Exception as e:
+                    logger.error(e)
+                    send_frame(self.request, {"error": str(e)})
+
+        with socketserver.ThreadingUnixStreamServer(self._socket_path, Handler) as server:
+            server.daemon_threads = True
+            server.serve_forever()
+
+    def _spawn(self):
+        slot = next(x for x in range(self._max_workers) if x not in self._workers)
+        tasks = self._context.Queue()
+        worker = self._context.Process(
+            target=run_worker,
+            args=(slot, self._threads, self._model_name, tasks, self._results),
+            daemon=True,
+        )
+        worker.start()
+        self._workers[slot] = (worker, tasks)
+        logger.info("Started embedding worker %s", slot)
+
+    def _dispatch(self):
+        while self._backlog and self._idle:
+            task_id = self._backlog.popleft()
+            if task_id not in self._tasks:
+                continue
+            slot = self._idle.pop()
+            self._assigned[slot] = task_id
+            self._workers[slot][1].put((task_id, self._tasks[task_id][0]))
+
+    def _collect(self):
+        while True:
+            slot, task_id, vectors, error, elapsed = self._results.get()
+            with self._lock:
+                if slot not in self._workers:
+                    continue
+                self._idle.add(slot)
+                self._assigned.pop(slot, None)
+                if not task_id:
+                    self._ready.add(slot)
+                    self._ever_ready = True
+                    self._startup_failures = 0
+                else:
+                    self._busy_seconds += elapsed
+                    self._completed += 1
+                    # The caller may have given up on the task already.
+                    if task_id in self._tasks:
+                        _, done, outcome = self._tasks[task_id]
+                        outcome.extend([vectors, error])
+                        done.set()
+                self._dispatch()
+
+    def _autoscale(self):
+        tick = time.monotonic()
+        while True:
+            time.sleep(1)
+            with self._lock:
+                now = time.monotonic()
+                self._window.append((self._busy_seconds, len(self._workers) * (now - tick)))
+                self._busy_seconds = 0.0
+                tick = now
+
+                for slot, (worker, _) in list(self._workers.items()):
+                    if not worker.is_alive():
+                        self._reap(slot)
+
+                waiting = len(self._backlog)
+                if waiting or self._assigned:
+                    self._last_busy = now
+
+                if now < self._next_spawn:
+                    pass
+                elif len(self._workers) < self._min_workers or (
+                        waiting and len(self._workers) < self._max_workers):
+                    self._spawn()
+                elif (len(self._workers) > self._min_workers and self._idle
+                      and now - self._last_busy > self._idle_seconds):
+                    self._retire(self._idle.pop())
+                    self._last_busy = now
+
+                self._dispatch()
+
+    def _reap(self, slot: int):
+        logger.warning("Embedding worker %s died", slot)
+        del self._workers[slot]
+        self._idle.discard(slot)
+        if slot in self._ready:
+            self._ready.discard(slot)
+        else:
+            self._startup_failed()
+        task_id = self._assigned.pop(slot, None)
+        if task_id not in self._tasks:
+            return
+
+        self._attempts[task_id] = self._attempts.get(task_id, 0) + 1
+        if self._attempts[task_id] < self._max_attempts:
+            self._backlog.appendleft(task_id)
+        else:
+            # The same texts killed a worker twice, so they are failed rather than retried forever.
+            _, done, outcome = self._tasks[task_id]
+            outcome.extend([None, f"Embedding worker died {self._max_attempts} times on this batch"])
+            done.set()
+
+    def _startup_failed(self):
+        self._startup_failures += 1
+        delay = min(60, 2 ** self._startup_failures)
+        self._next_spawn = time.monotonic() + delay
+        logger.error("Embedding worker failed to start, retrying in %ss", delay)
+
+        if self._ever_ready or self._workers:
+            return
+        # No worker has ever loaded the model, e.g. a bad model name, so callers fail now
+        # instead of waiting for their timeout.
+        for task_id in self._backlog:
+            if task_id in self._tasks:
+                _, done, outcome = self._tasks[task_id]
+                outcome.extend([None, "No embedding worker could start"])
+                done.set()
+        self._backlog.clear()
+
+    def _retire(self, slot: int):
+        self._ready.discard(slot)
+        worker, tasks = self._workers.pop(slot)
+        tasks.put(None)
+        logger.info("Retired embedding worker %s", slot)
+
+
+class PooledEmbeddings(Embeddings):
+    """Embeddings served by an EmbeddingPoolService over its Unix socket."""
+
+    def __init__(self, socket_path: str, model_name: str):
+        self._socket_path = socket_path
+        # Only used to namespace caches; it must match the model the pool was started with.
+        self.model_name = model_name
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        if not texts:
+            return []
+        return self._request({"op": "embed", "texts": texts})["vectors"]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+    @property
+    def stats(self) -> dict[str, float]:
+        return self._request({"op": "stats"})["stats"]
+
+    def _request(self, payload: dict) -> dict:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.connect(self._socket_path)
+            send_frame(connection, payload)
+            response = receive_frame(connection)
+
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
@@ -0,0 +1,93 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from langchain_core.documents import Document
+
+logger = logging.getLogger(__name__)
+
+
+class RerankService:
+    """
+    Rescores over-fetched candidates with a small cross-encoder on CPU and keeps the best few.
+    Falls back to the dense order when scoring does not fit into the latency budget.
+    """
+
+    def __init__(self):
+        self.enabled = os.getenv('RERANK_ENABLED', 'false').lower() == 'true'
+        self.candidates = int(os.getenv('RERANK_CANDIDATES', '24'))
+        self.top_k = int(os.getenv('RERANK_TOP_K', '4'))
+        self._model_name = os.getenv('RERANK_MODEL', 'cross-encoder/ms-marco-MiniLM-L-6-v2')
+        self._batch_size = int(os.getenv('RERANK_BATCH_SIZE', '8'))
+        self._budget = float(os.getenv('RERANK_BUDGET_SECONDS', '0.5'))
+        self._max_cache_size = int(os.getenv('RERANK_CACHE_SIZE', '4096'))
+        self._model = None
+        self._cache: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+        self._fallbacks = 0
+
+        if self.enabled:
+            # Loading on the first request would always blow its latency budget.
+            _ = self.model
+
+    @property
+    def model(self):
+        if not self._model:
+            # Imported here so torch is not loaded into processes that never rerank.
+            from sentence_transformers import CrossEncoder
+
+            logger.info(f"Initializing CrossEncoder({self._model_name})")
+            self._model = CrossEncoder(self._model_name, device='cpu')
+
+        return self._model
+
+    @property
+    def stats(self) -> dict[str, float]:
+        return {
+            "cache_size": len(self._cache),
+            "fallbacks": self._fallbacks,
+        }
+
+    def rerank(self, query: str, documents: list[Document]) -> list[Document]:
+        started = time.monotonic()
+
+        keys = [self.key(query, x) for x in documents]
+        with self._lock:
+            scores = {key: self._cache[key] for key in keys if key in self._cache}
+        pending = [(key, x) for key, x in zip(keys, documents) if key not in scores]
+
+        for start in range(0, len(pending), self._batch_size):
+            batch = pending[start:start + self._batch_size]
+            predicted = self.model.predict([(query, x.page_content) for _, x in batch], batch_size=self._batch_size)
+            for (key, _), score in zip(batch, predicted):
+                scores[key] = float(score)
+                self._remember(key, float(score))
+
+            # Once the budget is spent, remaining batches are skipped; scores computed so far stay cached
+            # for the next request. A ranking completed by the last batch is used, as its cost is already paid.
+            if start + self._batch_size < len(pending) and time.monotonic() - started > self._budget:
+                return self._fallback(documents)
+
+        ranked = sorted(zip(keys, documents), key=lambda x: scores[x[0]], reverse=True)
+        return [x for _, x in ranked[:self.top_k]]
+
+    def _fallback(self, documents: list[Document]) -> list[Document]:
+        with self._lock:
+            self._fallbacks += 1
+        logger.warning("Rerank exceeded %ss budget, using dense order", self._budget)
+        return documents[:self.top_k]
+
+    @staticmethod
+    def key(query: str, document: Document) -> str:
+        chunk = document.id or document.page_content
+        return hashlib.sha1(f"{query}\n{chunk}".encode()).hexdigest()
+
+    def _remember(self, key: str, score: float):
+        with self._lock:
+            self._cache[key] = score
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._max_cache_size:
+                self._cache.popitem(last=False)
@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from enum import StrEnum
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(StrEnum):
+    # Declaration order is service order.
+    interactive = 'interactive'
+    batch = 'batch'
+
+
+class Overloaded(Exception):
+    def __init__(self, status_code: int, retry_after: int, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class SchedulerService:
+    """
+    Admission control for LLM calls.
+
+    At most `max_in_flight` calls run at once. Everything else waits in per-user queues, which are
+    served round-robin within a priority class, interactive before batch. A caller that cannot be
+    queued, or waits longer than its deadline, is rejected instead of piling up.
+
+    State lives in the event loop of one process, so every uvicorn worker enforces its own cap;
+    the effective global limit is `max_in_flight` times the number of workers.
+    """
+
+    def __init__(self):
+        self._max_in_flight = int(os.getenv('LLM_MAX_IN_FLIGHT', '4'))
+        self._max_queue = int(os.getenv('LLM_MAX_QUEUE', '256'))
+        self._max_queue_per_user = int(os.getenv('LLM_MAX_QUEUE_PER_USER', '8'))
+        self._queue_timeouts = {
+            Priority.interactive: float(os.getenv('LLM_INTERACTIVE_QUEUE_TIMEOUT', '10')),
+            Priority.batch: float(os.getenv('LLM_BATCH_QUEUE_TIMEOUT', '60')),
+        }
+        self._in_flight = 0
+        self._queues: dict[Priority, OrderedDict[str, deque[asyncio.Future]]] = {
+            priority: OrderedDict() for priority in Priority
+        }
+        self._rejected = {429: 0, 503: 0}
+        # Running average of how long one admitted call holds its slot, seeded from configuration.
+        self._call_seconds = float(os.getenv('LLM_EXPECTED_CALL_SECONDS', '5'))
+        logger.info(f"Initializing SchedulerService({self._max_in_flight}, {self._max_queue})")
+
+    @property
+    def stats(self) -> dict[str, float]:
+        stats = {
+            "in_flight": self._in_flight,
+            "max_in_flight": self._max_in_flight,
+            "queued": self._queued(),
+            "average_call_seconds": self._call_seconds,
+            "rejected_429": self._rejected[429],
+            "rejected_503": self._rejected[503],
+        }
+        for priority, users in self._queues.items():
+            stats[f"queued_{priority.name}"] = sum(len(x) for x in users.values())
+            stats[f"queued_users_{priority.name}"] = len(users)
+        return stats
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, priority: Priority = Priority.interactive):
+        await self.acquire(user_id, priority)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._call_seconds = 0.9 * self._call_seconds + 0.1 * (time.monotonic() - started)
+            self.release()
+
+    async def acquire(self, user_id: str, priority: Priority = Priority.interactive):
+        if self._in_flight < self._max_in_flight and not self._queued():
+            self._in_flight += 1
+            return
+
+        users = self._queues[priority]
+        if len(users.get(user_id, ())) >= self._max_queue_per_user:
+            # Round-robin serves every queued user once per round, so the user's own queue
+            # drains only after that many rounds across all users of the class.
+            ahead = len(users[user_id]) * len(users)
+            raise self._reject(429, f"Too many queued requests for user {user_id}", ahead)
+        if self._queued() >= self._max_queue:
+            raise self._reject(503, "LLM queue is full", self._queued())
+
+        waiter = asyncio.get_running_loop().create_future()
+        users.setdefault(user_id, deque()).append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self._queue_timeouts[priority])
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was granted just as we gave up on it, so hand it on.
+                self.release()
+            else:
+                waiter.cancel()
+                self._discard(priority, user_id, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                raise self._reject(503, f"Queued longer than {self._queue_timeouts[priority]}s", self._queued())
+            raise
+
+    def release(self):
+        self._in_flight -= 1
+        while self._in_flight < self._max_in_flight:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
+
+    def _next_waiter(self):
+        for priority in Priority:
+            users = self._queues[priority]
+            if not users:
+                continue
+            # Round-robin: serve the oldest user, then move them to the back of the line.
+            user_id, waiters = next(iter(users.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            return waiter
+        return None
+
+    def _discard(self, priority: Priority, user_id: str, waiter: asyncio.Future):
+        waiters = self._queues[priority].get(user_id)
+        if waiters and waiter in waiters:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._queues[priority][user_id]
+
+    def _queued(self) -> int:
+        return sum(len(x) for users in self._queues.values() for x in users.values())
+
+    def _reject(self, status_code: int, reason: str, ahead: int) -> Overloaded:
+        self._rejected[status_code] += 1
+        # The calls ahead run `max_in_flight` at a time, each taking about one average call.
+        drains = math.ceil(max(1, ahead) / self._max_in_flight)
+        retry_after = max(1, math.ceil(drains * self._call_seconds))
+        logger.warning("Rejecting LLM call (%s): %s", status_code, reason)
+        return Overloaded(status_code, retry_after, reason)
@@ -0,0 +1,175 @@
+import asyncio
+import io
+import json
+import logging
+import os
+import queue
+import uuid
+from typing import BinaryIO, Iterator, Optional
+
+import numpy as np
+import pyarrow as pa
+from langchain_chroma import Chroma
+
+logger = logging.getLogger(__name__)
+
+
+class StreamBridge(io.RawIOBase):
+    """
+    A blocking file-like reader fed chunk by chunk from an event loop, so an upload can be loaded
+    while it is still arriving. The bounded queue makes a slow loader push back on the producer
+    without holding a worker thread while it waits.
+    """
+
+    def __init__(self, max_chunks: int = 16):
+        super().__init__()
+        self._chunks: queue.Queue[Optional[bytes]] = queue.Queue(max_chunks)
+        self._buffer = b""
+        self._eof = False
+        self._error: Optional[BaseException] = None
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer and not self._eof:
+            if self._error:
+                # A failed upload must not look like a clean end of stream to the loader.
+                raise IOError("Upload was aborted") from self._error
+            try:
+                chunk = self._chunks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if chunk is None:
+                self._eof = True
+            else:
+                self._buffer = chunk
+
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    async def feed(self, chunk: Optional[bytes]):
+        # Once the reader is closed, e.g. because the load failed, remaining chunks are dropped.
+        while not self.closed:
+            try:
+                self._chunks.put_nowait(chunk)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.01)
+
+    async def finish(self):
+        await self.feed(None)
+
+    def abort(self, error: BaseException):
+        self._error = error
+
+
+class SnapshotService:
+    """
+    Exports a session's chunks, metadata and vectors as an Arrow IPC stream and loads them back
+    without re-embedding, so moving or restoring a knowledge base is bound by I/O rather than CPU.
+    """
+
+    def __init__(self, vector_store: Chroma):
+        self._vector_store = vector_store
+        self._batch_size = int(os.getenv('SNAPSHOT_BATCH_SIZE', '1024'))
+
+    @staticmethod
+    def schema(dimensions: int) -> pa.Schema:
+        return pa.schema([
+            ("id", pa.string()),
+            ("content", pa.string()),
+            # Metadata keys differ between sources, so it is kept as a JSON document per chunk.
+            ("metadata", pa.string()),
+            ("embedding", pa.list_(pa.float32(), dimensions)),
+        ])
+
+    def batches(self, session_id: str) -> Iterator[pa.RecordBatch]:
+        collection = self._vector_store._collection
+        offset = 0
+        while True:
+            page = collection.get(
+                where={"session_id": session_id},
+                include=["documents", "metadatas", "embeddings"],
+                limit=self._batch_size,
+                offset=offset,
+            )
+            if not page["ids"]:
+                return
+
+            dimensions = len(page["embeddings"][0])
+            yield pa.record_batch([
+                pa.array(page["ids"], pa.string()),
+                pa.array(page["documents"], pa.string()),
+                pa.array([json.dumps(x) for x in page["metadatas"]], pa.string()),
+                pa.FixedSizeListArray.from_arrays(
+                    pa.array(np.asarray(page["embeddings"], dtype=np.float32).ravel()), dimensions
+                ),
+            ], schema=self.schema(dimensions))
+
+            offset += len(page["ids"])
+
+    def stream(self, session_id: str) -> Iterator[bytes]:
+        logger.info("Exporting snapshot of %s", session_id)
+
+        buffer = io.BytesIO()
+        writer = None
+        count = 0
+        for batch in self.batches(session_id):
+            if writer is None:
+                writer = pa.ipc.new_stream(buffer, batch.schema)
+            writer.write_batch(batch)
+            count += batch.num_rows
+            yield self._drain(buffer)
+
+        if writer is None:
+            writer = pa.ipc.new_stream(buffer, self.schema(0))
+        writer.close()
+        yield self._drain(buffer)
+
+        logger.info("Exported %s chunks of %s", count, session_id)
+
+    def export(self, session_id: str, sink: BinaryIO):
+        for chunk in self.stream(session_id):
+            sink.write(chunk)
+
+    def load(self, session_id: str, source: BinaryIO) -> int:
+        logger.info("Importing snapshot into %s", session_id)
+
+        collection = self._vector_store._collection
+        count = 0
+        with pa.ipc.open_stream(source) as reader:
+            for batch in reader:
+                if not batch.num_rows:
+                    continue
+
+                dimensions = batch.schema.field("embedding").type.list_size
+                # Vectors stay in Arrow/numpy buffers instead of turning into Python floats.
+                embeddings = batch.column("embedding").flatten().to_numpy().reshape(-1, dimensions)
+                metadatas = [json.loads(x) for x in batch.column("metadata").to_pylist()]
+                # The snapshot may come from another session, so it is re-owned by the target one.
+                # Foreign ids are remapped to avoid overwriting the origin session on the same node.
+                ids = [
+                    x if metadata.get("session_id") == session_id else str(uuid.uuid5(uuid.NAMESPACE_URL, f"{session_id}/{x}"))
+                    for x, metadata in zip(batch.column("id").to_pylist(), metadatas)
+                ]
+                metadatas = [metadata | {"session_id": session_id} for metadata in metadatas]
+                collection.upsert(
+                    ids=ids,
+                    documents=batch.column("content").to_pylist(),
+                    metadatas=metadatas,
+                    embeddings=embeddings,
+                )
+                count += batch.num_rows
+
+        logger.info("Imported %s chunks into %s", count, session_id)
+        return count
+
+    @staticmethod
+    def _drain(buffer: io.BytesIO) -> bytes:
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return chunk
@@ -1,3 +1,5 @@
+import asyncio
+import hashlib
 import logging
 import os
 from typing import Optional
@@ -5,10 +7,8 @@ from typing import TypedDict
 
 from dotenv import load_dotenv
 from langchain.embeddings import CacheBackedEmbeddings
-from langchain.globals import set_llm_cache
 from langchain.storage import LocalFileStore
 from langchain_chroma import Chroma
-from langchain_community.cache import SQLiteCache
 from langchain_community.llms.fake import FakeListLLM
 from langchain_core.chat_history import BaseChatMessageHistory, InMemoryChatMessageHistory
 from langchain_core.prompts import ChatPromptTemplate
@@ -18,20 +18,33 @@ from langchain_openai import ChatOpenAI
 from langgraph.constants import START
 from langgraph.graph import StateGraph
 
+from src.common.services.completion_cache import CompletionCacheService
+from src.common.services.embedding import EmbeddingService
+from src.common.services.embedding_pool import PooledEmbeddings
+from src.common.services.rerank import RerankService
+from src.common.services.scheduler import SchedulerService, Priority
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
 
+class SessionSummary(TypedDict):
+    summary: str
+    summarized: int
+
+
 class GlobalState(TypedDict):
     sessions: dict[str, InMemoryChatMessageHistory]
+    summaries: dict[str, SessionSummary]
 
 
 class PromptState(TypedDict):
     question: str
     history: str
     context: str
+    chunk_ids: list[str]
     answer: str
 
 
@@ -57,7 +70,13 @@ llm = ChatOpenRouter(
 #     temperature=0.7,
 # )
 
-global_state = GlobalState(sessions={})
+global_state = GlobalState(sessions={}, summaries={})
+
+# Older turns are folded into a running summary so the prompt stays roughly constant in size.
+history_recent_turns = int(os.getenv('HISTORY_RECENT_TURNS', '4'))
+history_token_budget = int(os.getenv('HISTORY_TOKEN_BUDGET', '1024'))
+# At most one summary per session is in progress; the tasks are kept here so they are not garbage collected.
+summary_tasks: dict[str, asyncio.Task] = {}
 
 
 def get_message_history_by_session_id(session_id: str) -> BaseChatMessageHistory:
@@ -67,6 +86,57 @@ def get_message_history_by_session_id(session_id: str) -> BaseChatMessageHistory
     return global_state["sessions"][session_id]
 
 
+def get_summary_by_session_id(session_id: str) -> SessionSummary:
+    return global_state["summaries"].get(session_id, SessionSummary(summary="", summarized=0))
+
+
+summary_template = """
+Current Summary:
+{summary}
+
+New Conversation Lines:
+{lines}
+
+Instruction:
+"Extend the current summary with the new conversation lines.
+Keep names, facts, preferences and open questions; drop small talk.
+Respond with the updated summary only, in at most ten sentences."
+
+Updated Summary:
+"""
+
+summary_prompt = ChatPromptTemplate.from_template(summary_template)
+
+
+def format_messages(messages) -> list[str]:
+    return [f"{x.type}: \"{x.content}\"" for x in messages]
+
+
+async def summarize_history(session_id: str, user_id: str):
+    messages = get_message_history_by_session_id(session_id).messages
+    current = get_summary_by_session_id(session_id)
+
+    fold_until = len(messages) - history_recent_turns * 2
+    if fold_until <= current["summarized"]:
+        return
+
+    lines = "\n".join(format_messages(messages[current["summarized"]:fold_until]))
+    # Summaries compete for the LLM like any other call, behind interactive completions.
+    async with scheduler.slot(user_id, Priority.batch):
+        completion = await (summary_prompt | llm).ainvoke({"summary": current["summary"], "lines": lines})
+
+    global_state["summaries"][session_id] = SessionSummary(summary=completion.content, summarized=fold_until)
+    logger.info("Summarized %s messages of %s", fold_until, session_id)
+
+
+async def safe_summarize_history(session_id: str, user_id: str):
+    try:
+        await summarize_history(session_id, user_id)
+    except Exception as e:
+        # The recent turns are still in the prompt, so a failed or rejected summary is retried on the next turn.
+        logger.error("Failed to summarize history of %s! %s", session_id, e)
+
+
 template = """
 User Query:
 "{question}"
@@ -89,6 +159,11 @@ Response:
 """
 
 prompt = ChatPromptTemplate.from_template(template)
+# Editing the template changes its version and with it every completion cache key.
+template_version = hashlib.sha256(template.encode()).hexdigest()[:12]
+
+completion_cache = CompletionCacheService()
+scheduler = SchedulerService()
 
 # embeddings = HuggingFaceEndpointEmbeddings(
 #     model="sentence-transformers/all-MiniLM-L6-v2",
@@ -99,25 +174,48 @@ embeddings = HuggingFaceEmbeddings(
     model_name="sentence-transformers/all-MiniLM-L6-v2",
     model_kwargs={'device': 'cpu'},
     encode_kwargs={'normalize_embeddings': False}
+) if not os.getenv('EMBEDDING_POOL_SOCKET') else PooledEmbeddings(
+    os.getenv('EMBEDDING_POOL_SOCKET'),
+    model_name="sentence-transformers/all-MiniLM-L6-v2",
 )
 
 cached_embedder = CacheBackedEmbeddings.from_bytes_store(
     embeddings, LocalFileStore("/home/honor/Projects/llm-knowledge-base/src/.cached_embeddings"), namespace=embeddings.model_name
 )
 
+query_cached_embedder = EmbeddingService.query_cached(
+    cached_embedder, embeddings.model_name, "/home/honor/Projects/llm-knowledge-base/src/.cached_embeddings"
+)
+
 vector_store = Chroma(
-    embedding_function=cached_embedder,
+    embedding_function=query_cached_embedder,
     persist_directory="/home/honor/Projects/llm-knowledge-base/src/.chroma",
 )
 
+reranker = RerankService()
+
 
 def enrich_history(state: PromptState, config: RunnableConfig):
     print(enrich_history.__name__, state)
 
     session_id = config["configurable"]["session_id"]
     session_history = get_message_history_by_session_id(session_id)
-
-    history = "\n".join([f"{x.type}: \"{x.content}\"" for x in session_history.messages])
+    summary = get_summary_by_session_id(session_id)
+
+    # The summarizer may lag behind, so unsummarized messages are kept newest first while they fit the budget.
+    # Tokens are approximated as 4 characters.
+    lines = format_messages(session_history.messages[summary["summarized"]:])
+    budget = history_token_budget * 4 - len(summary["summary"])
+    recent = []
+    for line in reversed(lines):
+        budget -= len(line)
+        if budget < 0 and recent:
+            break
+        recent.insert(0, line)
+
+    history = "\n".join(recent)
+    if summary["summary"]:
+        history = f"Summary of the earlier conversation: \"{summary['summary']}\"\n{history}"
 
     return {"history": history}
 
@@ -127,10 +225,13 @@ def enrich_context(state: PromptState, config: RunnableConfig):
 
     documents = vector_store.similarity_search(
         query=state["question"],
-        k=12,
+        k=reranker.candidates if reranker.enabled else 12,
         filter={"session_id": config["configurable"]["session_id"]},
     )
 
+    if reranker.enabled:
+        documents = reranker.rerank(state["question"], documents)
+
     context_template = """
 The source for the following context is {source_type} {source}:
 "{content}" 
@@ -145,19 +246,38 @@ The source for the following context is {source_type} {source}:
     ])
 
     missing_context = r"No context is available. Try adding more information to @lileg_db_bot."
-    return {"context": context or missing_context}
+    return {"context": context or missing_context, "chunk_ids": [x.id for x in documents]}
 
 
-def chatbot(state: PromptState, config: RunnableConfig):
+async def chatbot(state: PromptState, config: RunnableConfig):
     print(chatbot.__name__, state)
 
+    key = None
+    if completion_cache.enabled:
+        key = await asyncio.to_thread(
+            completion_cache.key,
+            llm.model_name, template_version, state["question"], state["chunk_ids"],
+            config["configurable"]["session_id"],
+        )
+        answer = await asyncio.to_thread(completion_cache.get, key)
+        if answer is not None:
+            return {"answer": answer}
+
+    # Only the LLM call itself is admitted, so cache hits and retrieval are never rejected.
     chain = prompt | llm
-    completion = chain.invoke({**state}, config)
+    async with scheduler.slot(
+            config["configurable"].get("user_id", config["configurable"]["session_id"]),
+            config["configurable"].get("priority", Priority.interactive),
+    ):
+        completion = await chain.ainvoke({**state}, config)
+
+    if key:
+        await asyncio.to_thread(completion_cache.put, key, completion.content)
 
     return {"answer": completion.content}
 
 
-def save_history(state: PromptState, config: RunnableConfig):
+async def save_history(state: PromptState, config: RunnableConfig):
     print(save_history.__name__, state)
 
     session_id = config["configurable"]["session_id"]
@@ -166,6 +286,14 @@ def save_history(state: PromptState, config: RunnableConfig):
     history.add_user_message(state["question"])
     history.add_ai_message(state["answer"])
 
+    # Hysteresis: wait until twice the recent window is unsummarized, then fold down to the window,
+    # so a summary costs one LLM call per N turns rather than one per turn.
+    if (len(history.messages) - get_summary_by_session_id(session_id)["summarized"] > history_recent_turns * 4
+            and session_id not in summary_tasks):
+        user_id = config["configurable"].get("user_id", session_id)
+        summary_tasks[session_id] = asyncio.create_task(safe_summarize_history(session_id, user_id))
+        summary_tasks[session_id].add_done_callback(lambda _: summary_tasks.pop(session_id, None))
+
     return {}
 
 
@@ -175,20 +303,16 @@ builder.add_sequence([enrich_history, enrich_context, chatbot, save_history])
 graph = builder.compile()
 
 if __name__ == "__main__":
-    set_llm_cache(SQLiteCache(database_path="/home/honor/Projects/llm-knowledge-base/src/.cached_completions"))
-
-    graph.invoke(
-        PromptState(question="My name is Oleh.", history="", context="", answer=""),
+    asyncio.run(graph.ainvoke(
+        PromptState(question="My name is Oleh.", history="", context="", chunk_ids=[], answer=""),
         RunnableConfig(configurable={"session_id": "1"}),
-    )
+    ))
     print(global_state["sessions"]["1"])
 
     vector_store = vector_store.from_texts(["My surname is Solomoichenko"], cached_embedder)
 
-    graph.invoke(
-        PromptState(question="What is my fullname?", history="", context="", answer=""),
+    asyncio.run(graph.ainvoke(
+        PromptState(question="What is my fullname?", history="", context="", chunk_ids=[], answer=""),
         RunnableConfig(configurable={"session_id": "1"}),
-    )
+    ))
     print(global_state["sessions"]["1"])
-
-set_llm_cache(SQLiteCache(database_path="/home/honor/Projects/llm-knowledge-base/src/.cached_completions"))
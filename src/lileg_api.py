@@ -1,23 +1,37 @@
+import asyncio
+import io
+import json
 import logging
+import os
+from contextlib import suppress
 from datetime import datetime, UTC
 from typing import Optional
 
+import anyio
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from langchain_core.documents import Document
 from langchain_core.runnables import RunnableConfig
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langdetect import detect
 from pydantic import BaseModel
 
-from infobase.lileg_agent import graph, vector_store, PromptState
+from src.common.services.snapshot import SnapshotService, StreamBridge
+from src.common.services.scheduler import Priority, Overloaded
+from src.common.services.embedding_pool import PooledEmbeddings
+from infobase.lileg_agent import graph, vector_store, embeddings, query_cached_embedder, reranker, completion_cache, \
+    scheduler, PromptState
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 app = FastAPI()
+snapshots = SnapshotService(vector_store)
+snapshot_imports = anyio.CapacityLimiter(int(os.getenv('SNAPSHOT_MAX_IMPORTS', '4')))
 
 
 class Prompt(BaseModel):
@@ -53,18 +67,25 @@ class Embedding(Identifiable):
 
 
 @app.post("/users/{user_id}/chats/{chat_id}/complete")
-async def complete(user_id: str, chat_id: str, prompt: Prompt) -> Completion:
+async def complete(user_id: str, chat_id: str, prompt: Prompt,
+                   priority: Priority = Priority.interactive) -> Completion:
     try:
         logger.info("Start completion %s", prompt)
 
-        result = graph.invoke(
-            PromptState(question=prompt.question, history="", context="", answer=""),
-            RunnableConfig(configurable={"session_id": f"{user_id}-{chat_id}"}),
+        result = await graph.ainvoke(
+            PromptState(question=prompt.question, history="", context="", chunk_ids=[], answer=""),
+            RunnableConfig(configurable={
+                "session_id": f"{user_id}-{chat_id}",
+                "user_id": user_id,
+                "priority": priority,
+            }),
         )
 
         logger.info("Finish completion %s", prompt)
 
         return Completion(answer=result["answer"])
+    except Overloaded as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
     except Exception as e:
         logger.error(e)
         raise HTTPException(status_code=500, detail=str(e))
@@ -127,6 +148,7 @@ async def remember(user_id: str, chat_id: str, infos: list[Information]) -> list
         )
 
         ids = await vector_store.aadd_documents(documents)
+        await run_in_threadpool(completion_cache.bump, f"{user_id}-{chat_id}")
 
         logger.info("Finish remembering")
         return [Identifiable(id=x) for x in ids]
@@ -141,6 +163,7 @@ async def forget(user_id: str, chat_id: str):
         logger.info("Start forgetting all")
 
         vector_store.delete(where={"session_id": f"{user_id}-{chat_id}"})
+        await run_in_threadpool(completion_cache.bump, f"{user_id}-{chat_id}")
 
         logger.info("Finish forgetting all")
     except Exception as e:
@@ -154,6 +177,7 @@ async def forget(user_id: str, chat_id: str, query: FilterQuery):
         logger.info("Start forgetting")
 
         vector_store.delete(where={"$and": [{"session_id": f"{user_id}-{chat_id}"}, query.filter]})
+        await run_in_threadpool(completion_cache.bump, f"{user_id}-{chat_id}")
 
         logger.info("Finish forgetting")
     except Exception as e:
@@ -182,5 +206,124 @@ async def similarity(user_id: str, chat_id: str, query: SearchQuery) -> list[Emb
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def batch_similarity_search(session_id: str, queries: list[SearchQuery]) -> list[list[Embedding]]:
+    vectors = query_cached_embedder.embed_queries([x.query for x in queries])
+
+    # Queries sharing a filter are looked up together in a single index query.
+    groups: dict[str, list[int]] = {}
+    for index, query in enumerate(queries):
+        groups.setdefault(json.dumps(query.filter, sort_keys=True), []).append(index)
+
+    results: list[list[Embedding]] = [[] for _ in queries]
+    for indexes in groups.values():
+        effective_filter = {"session_id": session_id}
+        if queries[indexes[0]].filter:
+            effective_filter = {"$and": [effective_filter, queries[indexes[0]].filter]}
+
+        found = vector_store._collection.query(
+            query_embeddings=[vectors[x] for x in indexes],
+            n_results=max(queries[x].n_results for x in indexes),
+            where=effective_filter,
+            include=["documents", "metadatas"],
+        )
+
+        for position, index in enumerate(indexes):
+            k = queries[index].n_results
+            results[index] = [
+                Embedding(id=identifier, metadata=metadata, content=content)
+                for identifier, metadata, content in zip(
+                    found["ids"][position][:k], found["metadatas"][position][:k], found["documents"][position][:k]
+                )
+            ]
+
+    return results
+
+
+@app.post("/users/{user_id}/chats/{chat_id}/similarity/batch")
+async def similarity_batch(user_id: str, chat_id: str, queries: list[SearchQuery]) -> list[list[Embedding]]:
+    try:
+        logger.info("Start batch similarity search of %s queries", len(queries))
+
+        results = await run_in_threadpool(batch_similarity_search, f"{user_id}-{chat_id}", queries)
+
+        logger.info("Finish batch similarity search")
+        return results
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def export_snapshot_chunks(session_id: str):
+    try:
+        yield from snapshots.stream(session_id)
+        logger.info("Finish exporting snapshot")
+    except Exception as e:
+        logger.error(e)
+        # Headers are already sent, so the connection is dropped without the final chunk
+        # rather than letting a truncated snapshot look complete.
+        raise
+
+
+@app.get("/users/{user_id}/chats/{chat_id}/snapshot")
+async def export_snapshot(user_id: str, chat_id: str) -> StreamingResponse:
+    logger.info("Start exporting snapshot")
+
+    return StreamingResponse(
+        export_snapshot_chunks(f"{user_id}-{chat_id}"),
+        media_type="application/vnd.apache.arrow.stream",
+    )
+
+
+def load_snapshot(session_id: str, source: StreamBridge) -> int:
+    try:
+        return snapshots.load(session_id, io.BufferedReader(source))
+    finally:
+        source.close()
+
+
+@app.post("/users/{user_id}/chats/{chat_id}/snapshot")
+async def import_snapshot(user_id: str, chat_id: str, request: Request) -> int:
+    try:
+        logger.info("Start importing snapshot")
+
+        # Batches are upserted as they arrive instead of buffering the whole upload.
+        # Loaders have their own thread limiter so long uploads cannot exhaust the shared threadpool.
+        source = StreamBridge()
+        loading = asyncio.ensure_future(anyio.to_thread.run_sync(
+            load_snapshot, f"{user_id}-{chat_id}", source, limiter=snapshot_imports
+        ))
+        try:
+            async for chunk in request.stream():
+                if chunk:
+                    await source.feed(chunk)
+        except BaseException as e:
+            source.abort(e)
+            with suppress(Exception):
+                await loading
+            raise
+        await source.finish()
+        count = await loading
+        await run_in_threadpool(completion_cache.bump, f"{user_id}-{chat_id}")
+
+        logger.info("Finish importing snapshot")
+        return count
+    except Exception as e:
+        logger.error(e)
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.get("/metrics")
+async def metrics() -> dict[str, dict[str, float]]:
+    result = {
+        "query_embeddings_cache": query_cached_embedder.stats,
+        "llm_scheduler": scheduler.stats,
+        "reranker": reranker.stats,
+        "completion_cache": await run_in_threadpool(lambda: completion_cache.stats),
+    }
+    if isinstance(embeddings, PooledEmbeddings):
+        result["embedding_pool"] = await run_in_threadpool(lambda: embeddings.stats)
+    return result
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000)
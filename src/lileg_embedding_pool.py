@@ -0,0 +1,13 @@
+import logging
+
+from dotenv import load_dotenv
+
+from src.common.services.embedding_pool import EmbeddingPoolService
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+if __name__ == "__main__":
+    EmbeddingPoolService().serve_forever()
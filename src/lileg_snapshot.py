@@ -0,0 +1,32 @@
+import argparse
+import logging
+
+from dotenv import load_dotenv
+
+from src.common.services.snapshot import SnapshotService
+from infobase.lileg_agent import vector_store, completion_cache
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+load_dotenv()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export or import a session knowledge base snapshot.")
+    parser.add_argument("command", choices=["export", "import"])
+    parser.add_argument("user_id")
+    parser.add_argument("chat_id")
+    parser.add_argument("path", help="Arrow IPC stream file")
+    args = parser.parse_args()
+
+    snapshots = SnapshotService(vector_store)
+    session_id = f"{args.user_id}-{args.chat_id}"
+
+    if args.command == "export":
+        with open(args.path, "wb") as f:
+            snapshots.export(session_id, f)
+    else:
+        with open(args.path, "rb") as f:
+            count = snapshots.load(session_id, f)
+        completion_cache.bump(session_id)
+        logger.info("Imported %s chunks into %s", count, session_id)